@@ -12,6 +12,8 @@ from utils import (
     reference_bucket,
     estimate_mfn_custom_product,
     load,
+    source_mtimes,
+    mfn_second_lowest,
 )
 from typing import Optional
 
@@ -158,9 +160,9 @@ if "additional_markets_version" not in st.session_state:
 
 
 
-# Load data once at startup
+# Load data once per version of the source files
 @st.cache_data
-def get_data():
+def load_data(mtimes: tuple):
     """Load data from get_processed_data"""
     r = get_processed_data(refresh=False)
     if not isinstance(r, list):
@@ -168,8 +170,13 @@ def get_data():
     return r
 
 
+def get_data():
+    """Cached processed data, keyed on the source file modification times"""
+    return load_data(source_mtimes())
+
+
 @st.cache_data
-def fetch_filter_options():
+def fetch_filter_options(mtimes: tuple):
     """Get available filter options from data"""
     try:
         data = get_data()
@@ -191,7 +198,7 @@ def fetch_filter_options():
 
 
 @st.cache_data
-def fetch_brand_specific_filters(brand: str):
+def fetch_brand_specific_filters(brand: str, mtimes: tuple):
     """Get countries and packs for a specific brand"""
     try:
         data = get_data()
@@ -247,27 +254,23 @@ def apply_gtn_to_agg(agg_data: list, gtn_map: dict) -> list:
         return agg_data
     
     # Create net price columns
+    gtn_series = df["country"].str.lower().map(gtn_map).fillna(0.0)
+    factor = 1.0 - gtn_series
     for col in ["cost_per_unit", "usd_price_per_unit", "ppp_price_per_unit", "ppp_price"]:
         if col in df.columns:
-            gtn_series = df["country"].str.lower().map(gtn_map).fillna(0.0)
-            factor = 1.0 - gtn_series
             df[f"net_{col}"] = df[col] * factor
     
     # Recompute MFN on gross PPP (original)
     if "ppp_price" in df.columns:
-        df["mfn_price"] = df.groupby(["year", "brand_name"])["ppp_price"].transform(
-            lambda x: x.nsmallest(2).max() if len(x.dropna()) >= 1 else float("nan")
-        )
+        df["mfn_price"] = mfn_second_lowest(df, ["year", "brand_name"], "ppp_price")
     
     # Recompute MFN on net PPP (new)
     if "net_ppp_price" in df.columns:
-        df["net_mfn_price"] = df.groupby(["year", "brand_name"])["net_ppp_price"].transform(
-            lambda x: x.nsmallest(2).max() if len(x.dropna()) >= 1 else float("nan")
-        )
+        df["net_mfn_price"] = mfn_second_lowest(df, ["year", "brand_name"], "net_ppp_price")
     
     # Reconstruct aggregated format
     result = []
-    for (brand, country, form), g in df.groupby(["brand_name", "country", "form"], sort=False):
+    for (brand, country, form), g in df.groupby(["brand_name", "country", "form"], observed=True, sort=False):
         year_dict = {}
         for _, row in g.iterrows():
             year = int(row["year"])
@@ -631,7 +634,7 @@ def main():
     # (Reset flags removed - now handled directly in button callbacks)
 
     # Fetch filter options
-    filter_options = fetch_filter_options()
+    filter_options = fetch_filter_options(source_mtimes())
 
     with st.container():
         col1, col2, col3 = st.columns([2, 1, 1])
@@ -814,9 +817,9 @@ def main():
 
         # Load default exchange rates from processed data
         try:
-            processed_data = load("processed_price_data")
+            processed_data = load("processed_price_data", columns=["country", "exchange_rate"])
             if not processed_data.empty:
-                default_rates = processed_data.groupby("country")["exchange_rate"].first().to_dict()
+                default_rates = processed_data.groupby("country", observed=True)["exchange_rate"].first().to_dict()
             else:
                 default_rates = {}
         except:
@@ -1014,7 +1017,7 @@ def main():
             if st.button("Estimate MFN Price", use_container_width=True, key="estimate_mfn_btn"):
                 # Get exchange rates and PPP rates (use custom or defaults)
                 try:
-                    processed_data = load("processed_price_data")
+                    processed_data = load("processed_price_data", columns=["country", "exchange_rate"])
                     ppp_data = load("ppp_2020_2023")
                     
                     exchange_rates = {}
@@ -1119,7 +1122,7 @@ def main():
 
     # Additional filters for Pack (only show when brand is selected)
     if selected_brand:
-        brand_filters = fetch_brand_specific_filters(selected_brand)
+        brand_filters = fetch_brand_specific_filters(selected_brand, source_mtimes())
 
         st.markdown("<br>", unsafe_allow_html=True)
 
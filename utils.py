@@ -1,4 +1,5 @@
 import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 import pandas as pd
 
 
@@ -13,6 +14,7 @@ reference_bucket = [
     "Switzerland",
     "United States of America",
 ]
+REFERENCE_BUCKET_LOWER = frozenset(c.lower() for c in reference_bucket)
 
 # Default gross-to-net (GTN) assumptions by market (fractions)
 DEFAULT_GTN_BY_COUNTRY = {
@@ -36,21 +38,57 @@ data_root = "./data"
 os.makedirs(data_root, exist_ok=True)
 
 
+def table_path(table_name: str) -> str:
+    return f"./{data_root}/{table_name}.parquet"
+
+
+# Parsed tables keyed by (path, columns) -> (file mtime, frame)
+_CACHE: Dict[tuple, Tuple[float, pd.DataFrame]] = {}
+
+
 def save(df: pd.DataFrame, table_name: str):
-    df.to_pickle(f"./{data_root}/{table_name}.pickle")
+    path = table_path(table_name)
+    for key in [k for k in _CACHE if k[0] == path]:
+        del _CACHE[key]
+    df.to_parquet(path, engine="pyarrow", compression="zstd")
 
 
 def load(
     table_name: str,
+    columns: Optional[List[str]] = None,
 ) -> pd.DataFrame:
-    if os.path.exists(f"./{data_root}/{table_name}.pickle"):
-        return pd.read_pickle(f"./{data_root}/{table_name}.pickle")
+    path = table_path(table_name)
+    if os.path.exists(path):
+        mtime = os.path.getmtime(path)
+        key = (path, None if columns is None else tuple(columns))
+        cached = _CACHE.get(key)
+        if cached is None or cached[0] != mtime:
+            df = pd.read_parquet(path, engine="pyarrow", columns=columns)
+            cached = _CACHE[key] = (mtime, df)
+        # Callers may modify the frame in place; hand out a copy, never the cache
+        return cached[1].copy()
     return pd.DataFrame()
 
 
+SOURCE_FILES = ("data.xlsx", "ppp_2020_2023.xlsx")
+
+
+def source_mtimes() -> tuple:
+    """Modification times of the source workbooks, None for missing files."""
+    paths = (f"./{data_root}/{name}" for name in SOURCE_FILES)
+    return tuple(os.path.getmtime(p) if os.path.exists(p) else None for p in paths)
+
+
+def is_fresh(path: str, *sources: str) -> bool:
+    """Whether cache file `path` exists and is no older than any existing source."""
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    return all(mtime >= os.path.getmtime(s) for s in sources if os.path.exists(s))
+
+
 import re
-from collections import defaultdict
-from typing import Iterable, Dict, Any
+import numpy as np
 import pandas as pd
 
 BASE_COLS = (
@@ -69,6 +107,15 @@ METRIC_COLS = (
     "cost_per_strength_unit",
 )
 
+YEAR_COL_RE = re.compile(r"^(?P<year>\d{4})-(?P<metric>.+)$")
+
+# Low-cardinality grouping keys stored as pandas categoricals
+CATEGORY_COLS = (
+    "brand_name",
+    "country",
+    "form",
+)
+
 
 def compute_second_lowest(values: pd.Series) -> float:
     """
@@ -83,6 +130,31 @@ def compute_second_lowest(values: pd.Series) -> float:
     return float(clean.nsmallest(2).max())
 
 
+def mfn_second_lowest(df: pd.DataFrame, keys: list, col: str) -> pd.Series:
+    """
+    Vectorized compute_second_lowest of `col` per `keys` group, broadcast to
+    every row of `df`. Ranks once, keeps the picked row, then broadcasts it.
+    """
+    groups = df.groupby(keys, observed=True, sort=False)[col]
+    target_rank = groups.transform("count").clip(upper=2)
+    pick = groups.rank(method="first") == target_rank
+    return (
+        df[col]
+        .where(pick)
+        .groupby([df[k] for k in keys], observed=True, sort=False)
+        .transform("max")
+    )
+
+
+def _second_lowest_value(values: np.ndarray):
+    """Second-lowest of a 1-D array via partial selection; None when empty."""
+    if values.size == 0:
+        return None
+    if values.size == 1:
+        return float(values[0])
+    return float(np.partition(values, 1)[1])
+
+
 def estimate_mfn_custom_product(
     market_prices: Dict[str, float],
     exchange_rates: Dict[str, float],
@@ -111,63 +183,55 @@ def estimate_mfn_custom_product(
     """
     if gtn_map is None:
         gtn_map = {}
-    
+
+    # Aligned arrays for markets that have both rates
+    countries = [
+        c
+        for c in market_prices
+        if c.lower() in exchange_rates and c.lower() in ppp_rates
+    ]
+    local = np.array([market_prices[c] for c in countries], dtype=float)
+    ex_rate = np.array([exchange_rates[c.lower()] for c in countries], dtype=float)
+    ppp_rate = np.array([ppp_rates[c.lower()] for c in countries], dtype=float)
+
+    # Drop non-positive rates (written so NaN rates pass, as before)
+    valid = ~((ex_rate <= 0) | (ppp_rate <= 0))
+    countries = [c for c, ok in zip(countries, valid) if ok]
+    usd_price = local[valid] * ex_rate[valid]
+    ppp_price = local[valid] / ppp_rate[valid]
+
     result = {
-        "usd_prices": {},
-        "ppp_prices": {},
+        "usd_prices": dict(zip(countries, usd_price.tolist())),
+        "ppp_prices": dict(zip(countries, ppp_price.tolist())),
         "net_prices": {},
-        "markets_used": [],
+        "markets_used": countries,
     }
-    
-    # Calculate USD and PPP prices
-    for country, local_price in market_prices.items():
-        country_lower = country.lower()
-        
-        if country_lower not in exchange_rates or country_lower not in ppp_rates:
-            continue
-        
-        ex_rate = exchange_rates[country_lower]
-        ppp_rate = ppp_rates[country_lower]
-        
-        if ex_rate <= 0 or ppp_rate <= 0:
-            continue
-        
-        usd_price = local_price * ex_rate
-        ppp_price = local_price / ppp_rate
-        
-        result["usd_prices"][country] = usd_price
-        result["ppp_prices"][country] = ppp_price
-        result["markets_used"].append(country)
-        
-        # Apply GTN if enabled
-        if apply_gtn and country_lower in gtn_map:
-            gtn_factor = 1.0 - gtn_map[country_lower]
-            net_price = ppp_price * gtn_factor
-            result["net_prices"][country] = net_price
-    
+
     # Calculate MFN as second-lowest PPP price
-    if len(result["ppp_prices"]) >= 1:
-        ppp_values = list(result["ppp_prices"].values())
-        if len(ppp_values) >= 2:
-            result["mfn_price"] = sorted(ppp_values)[1]
-        else:
-            result["mfn_price"] = min(ppp_values)
-    else:
-        result["mfn_price"] = None
-    
-    # Calculate net MFN if GTN applied
-    if apply_gtn and len(result["net_prices"]) >= 1:
-        net_values = list(result["net_prices"].values())
-        if len(net_values) >= 2:
-            result["net_mfn_price"] = sorted(net_values)[1]
-        else:
-            result["net_mfn_price"] = min(net_values)
+    result["mfn_price"] = _second_lowest_value(ppp_price)
+
+    # Apply GTN where a market has an assumption, then the net MFN
+    if apply_gtn:
+        has_gtn = np.array([c.lower() in gtn_map for c in countries], dtype=bool)
+        gtn = np.array([gtn_map.get(c.lower(), 0.0) for c in countries], dtype=float)
+        net_price = (ppp_price * (1.0 - gtn))[has_gtn]
+        net_countries = [c for c, ok in zip(countries, has_gtn) if ok]
+        result["net_prices"] = dict(zip(net_countries, net_price.tolist()))
+        result["net_mfn_price"] = _second_lowest_value(net_price)
     else:
         result["net_mfn_price"] = None
-    
+
     return result
 
 
+GTN_PRICE_COLS = (
+    "cost_per_unit",
+    "usd_price_per_unit",
+    "ppp_price_per_unit",
+    "ppp_price",
+)
+
+
 def apply_gtn(df: pd.DataFrame, gtn_map: dict) -> pd.DataFrame:
     """
     Apply country-level GTN rates to derive net prices and recompute MFN on net PPP.
@@ -178,33 +242,36 @@ def apply_gtn(df: pd.DataFrame, gtn_map: dict) -> pd.DataFrame:
     - net_ppp_price_per_unit
     - net_ppp_price
     - net_mfn_price
+
+    The returned frame shares the original columns' data with `df` (there is
+    no copy-on-write on pandas 2.x), so writing to e.g. its cost_per_unit in
+    place also changes `df`. Copy the result first if it will be modified.
     """
 
     if df.empty:
         return df
 
-    gtn_series = df["country"].str.lower().map(gtn_map).fillna(0.0)
-    factor = 1.0 - gtn_series
-
-    result = df.copy()
-
-    if "cost_per_unit" in result:
-        result["net_cost_per_unit"] = result["cost_per_unit"] * factor
-
-    if "usd_price_per_unit" in result:
-        result["net_usd_price_per_unit"] = result["usd_price_per_unit"] * factor
-
-    if "ppp_price_per_unit" in result:
-        result["net_ppp_price_per_unit"] = result["ppp_price_per_unit"] * factor
+    # Look up each distinct country once and broadcast through the codes
+    gtn_series = (
+        df["country"]
+        .astype("category")
+        .map(lambda c: gtn_map.get(c.lower(), 0.0), na_action="ignore")
+        .astype(float)
+        .fillna(0.0)
+    )
+    factor = (1.0 - gtn_series).to_numpy()
 
-    if "ppp_price" in result:
-        result["net_ppp_price"] = result["ppp_price"] * factor
+    # Shallow copy: the input columns are shared with `df`, only the net columns
+    # are new. DataFrame.assign would deep-copy the whole frame.
+    result = df.copy(deep=False)
+    for col in GTN_PRICE_COLS:
+        if col in df:
+            result[f"net_{col}"] = df[col].to_numpy() * factor
 
     # Recompute MFN using net PPP price
     if "net_ppp_price" in result:
-        result["net_mfn_price"] = (
-            result.groupby(["year", "brand_name"])["net_ppp_price"]
-            .transform(compute_second_lowest)
+        result["net_mfn_price"] = mfn_second_lowest(
+            result, ["year", "brand_name"], "net_ppp_price"
         )
 
     return result
@@ -219,8 +286,6 @@ def validate_df(
     if not isinstance(df, pd.DataFrame):
         raise TypeError("df must be a pandas DataFrame")
 
-    year_col_pattern = re.compile(r"^(?P<year>\d{4})-(?P<metric>.+)$")
-
     base_columns = set(base_columns)
     allowed_metrics = set(allowed_metrics)
 
@@ -232,33 +297,21 @@ def validate_df(
         "missing_metrics_by_year": {},
     }
 
-    seen_by_year = defaultdict(set)
-    observed_years = set()
-
-    for col in df.columns:
-        # base columns
-        if col in base_columns:
-            continue
-
-        match = year_col_pattern.match(col)
-        if not match:
-            errors["malformed_columns"].append(col)
-            continue
-
-        year = int(match.group("year"))
-        metric = match.group("metric")
-
-        if metric not in allowed_metrics:
-            errors["invalid_metrics"].append(col)
-            continue
+    # Classify every non-base column with one regex pass over the names
+    cols = pd.Index(df.columns)
+    cols = cols[~cols.isin(base_columns)]
+    parts = cols.astype(str).str.extract(YEAR_COL_RE)
+    matched = parts["year"].notna().to_numpy()
+    allowed = parts["metric"].isin(allowed_metrics).to_numpy()
 
-        observed_years.add(year)
-        seen_by_year[year].add(metric)
+    errors["malformed_columns"] = cols[~matched].tolist()
+    errors["invalid_metrics"] = cols[matched & ~allowed].tolist()
 
-    years_to_check = sorted(observed_years)
+    valid = parts[matched & allowed]
+    seen_by_year = valid.groupby(valid["year"].astype(int))["metric"].agg(set)
 
-    for year in years_to_check:
-        missing = allowed_metrics - seen_by_year.get(year, set())
+    for year, seen in seen_by_year.items():
+        missing = allowed_metrics - seen
         if missing:
             errors["missing_metrics_by_year"][year] = sorted(missing)
 
@@ -268,88 +321,107 @@ def validate_df(
 
 
 def load_or_build_long_table():
-    df = load("long_data_table")
-    if not df.empty:
-        return df
     file = f"./{data_root}/data.xlsx"
     df_path = f"./{data_root}/data.pickle"
-    if os.path.exists(df_path):
+    if is_fresh(table_path("long_data_table"), file):
+        df = load("long_data_table")
+        if not df.empty:
+            return df
+    if is_fresh(df_path, file):
         data = pd.read_pickle(df_path)
     else:
-        data = pd.read_excel(file)
+        data = pd.read_excel(file, engine="calamine")
         data.to_pickle(df_path)
     data.columns = data.columns.str.lower()
-    errors = validate_df(df)
+    # price_id mixes numeric and text ids; store as text so it is parquet-safe
+    data["price_id"] = data["price_id"].map(str, na_action="ignore")
+    # Lower-case country once on the wide frame; it becomes a categorical below
+    data["country"] = data["country"].str.lower()
+    errors = validate_df(data)
     if errors:
         _ = ""
         for k, v in errors.items():
             _ += f"{k.replace('_',' ').title()}: {v}\n"
         return _
-    data = data.rename(
-        columns=lambda c: (
-            f"{c.split('-', 1)[1]}-{c.split('-', 1)[0]}"
-            if c[:4].isdigit() and "-" in c
-            else c
-        )
+    # Split "<year>-<metric>" once into a (metric, year) column MultiIndex;
+    # any other column is carried along as an id, as wide_to_long did
+    parts = data.columns.str.extract(YEAR_COL_RE)
+    is_value = parts["metric"].isin(METRIC_COLS).to_numpy()
+    extra_cols = [c for c in data.columns[~is_value] if c not in BASE_COLS]
+    long_df = data.set_index(list(BASE_COLS) + extra_cols)[data.columns[is_value]]
+    long_df.columns = pd.MultiIndex.from_arrays(
+        [parts["metric"][is_value], parts["year"][is_value].astype(int)],
+        names=[None, "year"],
     )
-    id_cols = list(BASE_COLS)
     long_df = (
-        pd.wide_to_long(
-            data,
-            stubnames=list(METRIC_COLS),
-            i=id_cols,
-            j="year",
-            sep="-",
-            suffix=r"\d{4}",
-        )
+        long_df.stack(level="year", future_stack=True)
         .reset_index()
+        .astype({c: "category" for c in CATEGORY_COLS})
         .sort_values(["brand_name", "year"])
     )
     save(long_df, "long_data_table")
     return long_df
 
 
+def load_or_build_ppp_table():
+    file = f"./{data_root}/ppp_2020_2023.xlsx"
+    if is_fresh(table_path("ppp_2020_2023"), file):
+        ppp = load("ppp_2020_2023")
+        if not ppp.empty:
+            return ppp
+    ppp = pd.read_excel(file, engine="calamine")
+    ppp["country"] = ppp["country"].str.lower()
+    save(ppp, "ppp_2020_2023")
+    return ppp
+
+
+AGG_VALUE_COLS = {
+    "cost_per_unit": "Cost Per Unit Local",
+    "usd_price_per_unit": "Cost Per Unit USD",
+    "ppp_price_per_unit": "Cost Per Unit PPP",
+    "mfn_price": "MFN Price USD",
+}
+
+
 def get_agg(df: pd.DataFrame):
-    result = []
-    for (brand, country, pack), g in df.groupby(
-        ["brand_name", "country", "form"], sort=False
-    ):
-        year_dict = {}
-        for _, row in g.iterrows():
-            year_dict[row["year"]] = {
-                "Cost Per Unit Local": row["cost_per_unit"],
-                "Cost Per Unit USD": row["usd_price_per_unit"],
-                "Cost Per Unit PPP": row["ppp_price_per_unit"],
-                "MFN Price USD": row["mfn_price"],
-            }
-        result.append(
-            {
-                "Brand Name": brand,
-                "Country": country.title(),
-                "Pack": pack,
-                "Year": year_dict,
-            }
-        )
-    return result
+    # Row positions per group plus column-wise extraction; no per-row Series
+    years = df["year"].tolist()
+    values = (
+        df[list(AGG_VALUE_COLS)]
+        .rename(columns=AGG_VALUE_COLS)
+        .to_dict(orient="records")
+    )
+    groups = df.groupby(
+        ["brand_name", "country", "form"], observed=True, sort=False
+    ).indices
+    # .indices is keyed in category order; emit groups in order of appearance
+    ordered = sorted(groups.items(), key=lambda item: item[1][0])
+    return [
+        {
+            "Brand Name": brand,
+            "Country": country.title(),
+            "Pack": pack,
+            "Year": {years[i]: values[i] for i in idx},
+        }
+        for (brand, country, pack), idx in ordered
+    ]
+
+
+UNROLL_COLS = ("brand_name", "country", "form", "year", *AGG_VALUE_COLS)
 
 
 def unroll_agg(agg):
-    rows = []
+    # Fill one list per column in a single pass, then build column-wise
+    columns = {c: [] for c in UNROLL_COLS}
     for rec in agg:
         for year, values in rec["Year"].items():
-            rows.append(
-                {
-                    "brand_name": rec["Brand Name"],
-                    "country": rec["Country"],
-                    "form": rec["Pack"],
-                    "year": year,
-                    "cost_per_unit": values["Cost Per Unit Local"],
-                    "usd_price_per_unit": values["Cost Per Unit USD"],
-                    "ppp_price_per_unit": values["Cost Per Unit PPP"],
-                    "mfn_price": values["MFN Price USD"],
-                }
-            )
-    return pd.DataFrame(rows)
+            columns["brand_name"].append(rec["Brand Name"])
+            columns["country"].append(rec["Country"])
+            columns["form"].append(rec["Pack"])
+            columns["year"].append(year)
+            for col, label in AGG_VALUE_COLS.items():
+                columns[col].append(values[label])
+    return pd.DataFrame(columns)
 
 
 def get_processed_data(refresh=False):
@@ -358,13 +430,13 @@ def get_processed_data(refresh=False):
         df_path = f"./{data_root}/data.pickle"
         df = load_or_build_long_table()
         if isinstance(df, str):
-            return str
+            return df
         df.drop(columns=["price_id", "formulation"], inplace=True, errors="ignore")
-        ppp_2020_2023 = f"./{data_root}/ppp_2020_2023.xlsx"
-        ppp_2020_2023_data = pd.read_excel(ppp_2020_2023)
-        ppp_2020_2023_data["country"] = ppp_2020_2023_data["country"].str.lower()
-        save(ppp_2020_2023_data, "ppp_2020_2023")
-        ppp = load("ppp_2020_2023")
+        ppp = load_or_build_ppp_table()
+        ppp_ = ppp.melt(id_vars="country", var_name="year", value_name="ppp_rate")
+        ppp_["year"] = ppp_["year"].astype(int)
+        ppp_ = ppp_.drop_duplicates(subset=["country", "year"])
+        ppp_lookup = ppp_.set_index(["country", "year"])["ppp_rate"]
         UNIQUE_COLS = ["brand_name", "country", "form", "year"]
         PRICE_COLS = [
             "price",
@@ -376,55 +448,68 @@ def get_processed_data(refresh=False):
             subset=PRICE_COLS,
             how="all",
         )
-        df["country"] = df["country"].str.lower()
-        df = df[df["country"].isin([i for i in {_.lower() for _ in reference_bucket}])]
-        brand_year_country_count = df.groupby(["brand_name", "year"])[
-            "country"
-        ].nunique()
-        bad_brand_years = brand_year_country_count[brand_year_country_count < 5].index
-        bad_brand_years
-        df = df[~df.set_index(["brand_name", "year"]).index.isin(bad_brand_years)]
+        # Filter to reference markets and PPP years up front so every later
+        # step (counts, fills, joins) only touches rows that can be kept
+        df = df[
+            df["year"].isin(ppp_["year"].unique())
+            & df["country"].isin(REFERENCE_BUCKET_LOWER)
+        ]
+        # Distinct countries per (brand, year): dedupe the pairs, then count rows
+        pairs = df[["brand_name", "year", "country"]].drop_duplicates()
+        brand_year_country_count = pairs.groupby(
+            ["brand_name", "year"], observed=True, sort=False
+        ).size()
+        # Anti-join away (brand, year) pairs priced in fewer than five markets
+        bad_brand_years = (
+            brand_year_country_count[brand_year_country_count < 5]
+            .reset_index()[["brand_name", "year"]]
+            .assign(_bad=1)
+        )
+        df = df.merge(bad_brand_years, on=["brand_name", "year"], how="left")
+        df = df[df["_bad"].isna()].drop(columns="_bad")
         df.loc[df["target_currency"] == "GBP", "exchange_rate"] = 1.0
-        df[df["exchange_rate"].isna()][["country", "year"]].drop_duplicates()[
-            "year"
-        ].value_counts().sort_index()
         need_exchange_rate_EUR_countries = ["france", "belgium"]
-        need_exchange_rate_EUR_countries = ["france", "belgium"]
-        germany_rates = df[df["country"] == "germany"][["year", "exchange_rate"]]
-        df = df.merge(germany_rates, on="year", how="left", suffixes=("", "_germany"))
+        # EUR markets missing a rate borrow Germany's (first) rate for that year
+        germany_rates = (
+            df.loc[df["country"] == "germany", ["year", "exchange_rate"]]
+            .drop_duplicates("year")
+            .set_index("year")["exchange_rate"]
+        )
         mask = (
             df["country"].isin(need_exchange_rate_EUR_countries)
             & df["exchange_rate"].isna()
         )
-        df.loc[mask, "exchange_rate"] = df.loc[mask, "exchange_rate_germany"]
+        df.loc[mask, "exchange_rate"] = df.loc[mask, "year"].map(germany_rates)
         df.loc[
             df["target_currency"].isna() & df["country"].isin(["france", "belgium"]),
             "target_currency",
         ] = "USD"
-        df = df.drop(columns=["exchange_rate_germany"])
-        df["usd_price_per_unit"] = df["cost_per_unit"] * df["exchange_rate"]
-        ppp_ = ppp.melt(id_vars="country", var_name="year", value_name="ppp_rate")
-        ppp_["year"] = ppp_["year"].astype(int)
-        df = df[
-            df["year"].isin(ppp_["year"].unique())
-            & df["country"].isin([i for i in {_.lower() for _ in reference_bucket}])
-        ]
-        df = df.merge(ppp_, on=["country", "year"], how="left")
-        df.drop_duplicates(inplace=True, subset=UNIQUE_COLS)
-        df.dropna(subset=["usd_price_per_unit"], inplace=True)
-        df["usd_price"] = df["price"] * df["exchange_rate"]
-        df["ppp_price_per_unit"] = df["cost_per_unit"] / df["ppp_rate"]
-        df["ppp_price"] = df["price"] / df["ppp_rate"]
-        df.drop(columns=["ppp_rate"], inplace=True)
-        df["mfn_price"] = df.groupby(["year", "brand_name"])["ppp_price"].transform(
-            lambda x: x.nsmallest(2).max()
+        # One row per (brand, country, form, year); dedupe before the PPP lookup
+        df = df.drop_duplicates(subset=UNIQUE_COLS, keep="first")
+        # Direct (country, year) -> rate lookup against the small PPP table
+        ppp_rate = (
+            pd.MultiIndex.from_arrays([df["country"].to_numpy(), df["year"].to_numpy()])
+            .map(ppp_lookup)
+            .to_numpy()
         )
+        cost, price = df["cost_per_unit"], df["price"]
+        df = df.assign(
+            usd_price_per_unit=cost * df["exchange_rate"],
+            usd_price=price * df["exchange_rate"],
+            ppp_price_per_unit=cost / ppp_rate,
+            ppp_price=price / ppp_rate,
+        )
+        df = df.dropna(subset=["usd_price_per_unit"])
+        df["mfn_price"] = mfn_second_lowest(df, ["year", "brand_name"], "ppp_price")
         df = df.reset_index(drop=True)
         save(df, "processed_price_data")
         return get_agg(df)
 
     if not refresh:
         try:
+            sources = [f"./{data_root}/{name}" for name in SOURCE_FILES]
+            if not is_fresh(table_path("processed_price_data"), *sources):
+                return _()
             df = load("processed_price_data")
             if df.empty:
                 return _()